@@ -1,16 +1,29 @@
 import os
 import csv
+import io
+import math
+import mmap
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from operator import attrgetter
 import humanize
 import re
+import shutil
+import sys
 from pathlib import Path
 from tqdm import tqdm
 
 # Configuration
 ROOT_DIRECTORY = "/path/to/scan"  # Directory to scan
 OUTPUT_DIRECTORY = "/path/to/output"  # Directory where CSV will be saved
+SCAN_WORKERS = None  # Directories scanned in parallel (None picks a default from the CPU count)
+HUMAN_READABLE_SIZES = True  # Include the human-readable size column next to raw_size
+MMAP_OUTPUT = False  # Write CSV files through a memory map (can help for multi-GB inventories)
 
-# Files to clean up (macOS specific and general hidden files)
+# Files to clean up (macOS specific and general hidden files).
+# For reference only: matching is done by CLEANUP_PATTERN below.
 CLEANUP_FILES = {
     '.DS_Store',
     '.localized',
@@ -27,164 +40,360 @@ CLEANUP_FILES = {
     '.apdisk'
 }
 
+# Matches hidden files (every entry above but Thumbs.db, plus ._ resource
+# forks) and Thumbs.db
+CLEANUP_PATTERN = re.compile(r'\.|Thumbs\.db\Z')
+
+# macOS metadata directories, removed as a whole without scanning them.
+# Other hidden directories are left alone and skipped during the walk.
+PRUNE_DIRS = frozenset({
+    '.AppleDouble',
+    '.DocumentRevisions-V100',
+    '.Spotlight-V100',
+    '.TemporaryItems',
+    '.Trashes',
+    '.fseventsd'
+})
+
+# Write buffer for the CSV output files, and how many characters of
+# formatted rows to collect in memory before handing them to the file
+CSV_BUFFER_SIZE = 4 * 1024 * 1024
+CSV_BLOCK_SIZE = 1 << 20
+
+# How much a memory-mapped output file grows by when it fills up
+MMAP_CHUNK_SIZE = 1 << 26
+
+# CSV headers in desired order
+FILE_HEADERS = ['relative_path', 'filename', 'size', 'raw_size', 'modified', 'directory']
+RAW_SIZE_FILE_HEADERS = ['relative_path', 'filename', 'raw_size', 'modified', 'directory']
+DIR_HEADERS = ['directory_path', 'depth', 'parent_directory', 'directory_name']
+
 class FileStats:
     def __init__(self):
         self.total_files = 0
         self.cleaned_files = 0
         self.cleaned_size = 0
+        self.cleaned_dirs = 0
+        self.inventoried_files = 0
         self.errors = []
 
-def should_clean_file(filename, filepath):
+    def merge(self, other):
+        self.total_files += other.total_files
+        self.cleaned_files += other.cleaned_files
+        self.cleaned_size += other.cleaned_size
+        self.cleaned_dirs += other.cleaned_dirs
+        self.inventoried_files += other.inventoried_files
+        self.errors.extend(other.errors)
+
+class MmapFile:
     """
-    Check if the file should be cleaned up.
-    Returns True for hidden files and macOS system files.
+    Write-only UTF-8 text file that copies data into a memory map instead of
+    calling write(). The file grows in MMAP_CHUNK_SIZE steps and is truncated
+    to the written length on close.
     """
-    # Match files that start with a dot (hidden files)
-    if filename.startswith('.'):
-        return True
-        
-    # Match files in the cleanup list
-    if filename in CLEANUP_FILES:
-        return True
-        
-    # Match macOS resource fork files
-    if filename.startswith('._'):
-        return True
+    def __init__(self, output_file):
+        self.file = open(output_file, 'w+b')
+        self.mm = None
+        self.size = 0
+        self.pos = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        end = self.pos + len(data)
+        if end > self.size:
+            self._grow(end)
+        self.mm[self.pos:end] = data
+        self.pos = end
+
+    def _grow(self, min_size):
+        # Remap rather than resize, which isn't supported everywhere
+        if self.mm is not None:
+            self.mm.close()
+        self.size = max(min_size, self.size + MMAP_CHUNK_SIZE)
+        os.ftruncate(self.file.fileno(), self.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        os.ftruncate(self.file.fileno(), self.pos)
+        self.file.close()
+
+class BlockCsvWriter:
+    """
+    CSV writer that formats rows into an in-memory buffer and writes them
+    to the output file in large blocks. Creates the output directory and
+    writes the header row on open; use as a context manager.
+    """
+    def __init__(self, output_file, headers):
+        # Create output directory if it doesn't exist
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
         
-    # Match .AppleDouble directories and their contents
-    if '.AppleDouble' in filepath:
-        return True
+        if MMAP_OUTPUT:
+            self.csvfile = MmapFile(output_file)
+        else:
+            self.csvfile = open(output_file, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.writerow(headers)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        if self.buffer.tell() >= CSV_BLOCK_SIZE:
+            self.flush()
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+        if self.buffer.tell() >= CSV_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.csvfile.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        self.flush()
+        self.csvfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def scan_directory(path, rel_dir):
+    """
+    Clean up and inventory the files of a single directory.
+    rel_dir is the path of the directory relative to the root ('' for the root).
+    Returns the remaining files as (relative_path, filename, raw_size, mtime,
+    directory) tuples, the (path, rel_dir) pairs of subdirectories to descend
+    into and the statistics for this directory only, so it can run in a
+    worker thread.
+    """
+    # Where supported, work through a descriptor for the directory so stat and
+    # unlink calls are resolved relative to it instead of from the full path
+    dir_fd = None
+    if os.scandir in os.supports_fd and os.unlink in os.supports_dir_fd:
+        try:
+            dir_fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        except OSError:
+            # Scanning by path below reports the error
+            pass
     
-    return False
+    try:
+        return scan_directory_entries(path, dir_fd, rel_dir)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
 
-def clean_directory(root_path, stats):
+def scan_directory_entries(path, dir_fd, rel_dir):
     """
-    Clean up hidden and system files while walking through the directory.
-    Returns a list of remaining files for inventory.
+    Does the work of scan_directory, reading the directory through dir_fd
+    when it isn't None.
     """
     file_data = []
+    subdirs = []
+    cleanup = []
+    prune = []
+    stats = FileStats()
     
-    print("\nScanning and cleaning directory...")
+    try:
+        with os.scandir(path if dir_fd is None else dir_fd) as it:
+            # Sort entries for consistent processing
+            entries = sorted(it, key=attrgetter('name'))
+    except OSError as e:
+        error_msg = f"Error scanning {path}: {e}"
+        print(f"\n{error_msg}")
+        stats.errors.append(error_msg)
+        return file_data, subdirs, stats
     
-    # Walk through directory with sorted order
-    for dirpath, dirnames, filenames in os.walk(root_path, topdown=True):
-        # Remove hidden directories from the walk
-        dirnames[:] = [d for d in sorted(dirnames) if not d.startswith('.')]
-        
-        # Sort files for consistent processing
-        filenames.sort()
+    # Bind what the loop uses per entry to locals to avoid repeated lookups
+    prefix = rel_dir + os.sep if rel_dir else ''
+    # Entries read through a descriptor only carry the name as their path,
+    # so full paths are built from this where they're needed
+    path_prefix = os.path.join(path, '')
+    clean_match = CLEANUP_PATTERN.match
+    add_subdir = subdirs.append
+    add_cleanup = cleanup.append
+    add_file = file_data.append
+    
+    for entry in entries:
+        name = entry.name
         
-        for filename in filenames:
-            full_path = os.path.join(dirpath, filename)
+        try:
+            # Skip hidden directories and don't follow directory symlinks;
+            # is_dir() can fail too, e.g. on a symlink loop
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    if name in PRUNE_DIRS:
+                        prune.append(path_prefix + name)
+                    elif not name.startswith('.'):
+                        add_subdir((path_prefix + name, prefix + name))
+                continue
+            
             stats.total_files += 1
             
-            try:
-                if should_clean_file(filename, full_path):
-                    # Get file size before deletion for statistics
-                    try:
-                        file_size = os.path.getsize(full_path)
-                        stats.cleaned_size += file_size
-                    except:
-                        pass
-                    
-                    # Delete the file
-                    os.remove(full_path)
-                    stats.cleaned_files += 1
-                    continue
-                
-                # Process remaining files for inventory
-                file_stats = os.stat(full_path)
-                rel_path = os.path.relpath(full_path, root_path)
-                
-                file_info = {
-                    'filename': filename,
-                    'relative_path': rel_path,
-                    'size': humanize.naturalsize(file_stats.st_size),
-                    'raw_size': file_stats.st_size,
-                    'modified': datetime.fromtimestamp(file_stats.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
-                    'directory': os.path.dirname(rel_path)
-                }
-                file_data.append(file_info)
-                
-            except Exception as e:
-                error_msg = f"Error processing {full_path}: {e}"
-                print(f"\n{error_msg}")
-                stats.errors.append(error_msg)
-    
-    # Sort the final list by relative path
-    file_data.sort(key=lambda x: x['relative_path'])
-    return file_data
-
-def save_to_csv(file_data, output_file):
-    # Create output directory if it doesn't exist
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    
-    print("\nSaving inventory to CSV...")
-    # Define CSV headers in desired order
-    headers = ['relative_path', 'filename', 'size', 'raw_size', 'modified', 'directory']
-    
-    # Write to CSV file with progress bar
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=headers)
-        writer.writeheader()
-        
-        # Write rows with progress bar
-        for row in tqdm(file_data, desc="Writing to CSV", unit="row"):
-            writer.writerow(row)
+            # One lstat per file, except on Windows where readdir already provides it
+            file_stats = entry.stat(follow_symlinks=False)
+            
+            if clean_match(name):
+                # Queue the file for deletion once the directory is processed
+                add_cleanup((name, file_stats.st_size))
+                continue
+            
+            # Process remaining files for inventory, formatting happens on output
+            add_file((prefix + name, name, file_stats.st_size, file_stats.st_mtime, rel_dir))
+            
+        except Exception as e:
+            error_msg = f"Error processing {path_prefix + name}: {e}"
+            print(f"\n{error_msg}")
+            stats.errors.append(error_msg)
+    
+    stats.inventoried_files = len(file_data)
+    
+    if cleanup:
+        remove_files(path, dir_fd, cleanup, stats)
+    
+    # Protected system directories may refuse removal, so only count what went
+    for dir_path in prune:
+        remove_directory(dir_path, stats)
+        if not os.path.lexists(dir_path):
+            stats.cleaned_dirs += 1
+    
+    return file_data, subdirs, stats
 
-def get_directory_structure(file_data):
+def remove_files(path, dir_fd, cleanup, stats):
     """
-    Extract unique directories from file data and create directory structure list
+    Delete the (filename, size) pairs in cleanup from the directory at path,
+    unlinking relative to dir_fd when it isn't None.
     """
-    directories = set()
-    dir_data = []
-    
-    # Get unique directories
-    for file_info in file_data:
-        rel_path = file_info['relative_path']
-        current_path = ''
-        # Add each level of the path
-        for part in rel_path.split(os.sep):
-            if current_path:
-                current_path = os.path.join(current_path, part)
+    for filename, file_size in cleanup:
+        try:
+            if dir_fd is None:
+                os.unlink(os.path.join(path, filename))
             else:
-                current_path = part
-            directories.add(os.path.dirname(current_path))
-    
-    # Remove empty string if present
-    directories.discard('')
+                os.unlink(filename, dir_fd=dir_fd)
+            stats.cleaned_files += 1
+            stats.cleaned_size += file_size
+        except Exception as e:
+            error_msg = f"Error processing {os.path.join(path, filename)}: {e}"
+            print(f"\n{error_msg}")
+            stats.errors.append(error_msg)
+
+def remove_directory(dir_path, stats):
+    """
+    Delete the directory tree at dir_path, recording anything that can't be
+    removed in stats.errors and carrying on with the rest of the tree.
+    """
+    def on_error(func, path, exc):
+        # onerror passes an exc_info tuple, onexc the exception itself
+        if isinstance(exc, tuple):
+            exc = exc[1]
+        error_msg = f"Error removing {path}: {exc}"
+        print(f"\n{error_msg}")
+        stats.errors.append(error_msg)
     
-    # Convert to list and sort
-    dir_list = sorted(list(directories))
+    if sys.version_info >= (3, 12):
+        shutil.rmtree(dir_path, onexc=on_error)
+    else:
+        shutil.rmtree(dir_path, onerror=on_error)
+
+def clean_directory(root_path, stats, directories):
+    """
+    Clean up hidden and system files while walking through the directory.
+    Yields the remaining files of each directory as it is scanned, and adds
+    every directory entered (relative to the root) to directories.
+    """
+    print("\nScanning and cleaning directory...")
     
-    # Create directory information list
-    for dir_path in dir_list:
-        dir_info = {
-            'directory_path': dir_path,
-            'depth': len(dir_path.split(os.sep)) if dir_path else 0,
-            'parent_directory': os.path.dirname(dir_path) if dir_path else '',
-            'directory_name': os.path.basename(dir_path) if dir_path else ''
-        }
-        dir_data.append(dir_info)
+    progress = tqdm(desc="Scanning", unit="file", mininterval=1.0, miniters=10000)
     
-    return dir_data
+    # Scan directories concurrently so several readdir/stat calls are in flight
+    max_workers = SCAN_WORKERS or min(32, (os.cpu_count() or 1) * 4)
+    # Cap the scans submitted but not yet consumed, so the walk can only get
+    # a bounded distance ahead of whoever is writing the results
+    max_in_flight = 2 * max_workers
+    in_flight = 0
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # Directories still to be yielded, in output order, as
+        # [path, rel_dir, future] with future None until submitted
+        pending = deque([[root_path, '', None]])
+        
+        # Drain results depth-first so each subtree comes out as one block,
+        # close to sorted order
+        while pending:
+            # Start scanning the directories that will be needed next, always
+            # including the one about to be yielded
+            for index, item in enumerate(pending):
+                if index and in_flight >= max_in_flight:
+                    break
+                if item[2] is None:
+                    item[2] = executor.submit(scan_directory, item[0], item[1])
+                    in_flight += 1
+            
+            _, rel_dir, future = pending.popleft()
+            in_flight -= 1
+            dir_files, subdirs, dir_stats = future.result()
+            
+            # Record each directory once, when it is entered
+            if rel_dir:
+                directories.add(rel_dir)
+            
+            stats.merge(dir_stats)
+            progress.update(dir_stats.total_files)
+            pending.extendleft([subdir, subdir_rel, None] for subdir, subdir_rel in reversed(subdirs))
+            
+            yield dir_files
+    finally:
+        # Scans delete files, so after an error or Ctrl-C don't start any
+        # that are still queued
+        executor.shutdown(wait=True, cancel_futures=True)
+        progress.close()
 
-def save_directory_structure(dir_data, output_file):
-    # Create output directory if it doesn't exist
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    
+@lru_cache(maxsize=65536)
+def format_mtime(timestamp):
+    """
+    Format a modification time floored to the whole second, as
+    datetime.fromtimestamp does. Cached because files that were copied,
+    extracted or built together tend to share timestamps.
+    """
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+def file_row(file_info):
+    """
+    Format a scanned file as a row in FILE_HEADERS order
+    """
+    relative_path, filename, raw_size, mtime, directory = file_info
+    return (
+        relative_path,
+        filename,
+        humanize.naturalsize(raw_size),
+        raw_size,
+        format_mtime(math.floor(mtime)),
+        directory
+    )
+
+def file_row_raw_size(file_info):
+    """
+    Format a scanned file as a row in RAW_SIZE_FILE_HEADERS order
+    """
+    relative_path, filename, raw_size, mtime, directory = file_info
+    return (relative_path, filename, raw_size, format_mtime(math.floor(mtime)), directory)
+
+def directory_row(rel_dir):
+    """
+    Format a directory relative to the root as a row in DIR_HEADERS order
+    """
+    parent, _, name = rel_dir.rpartition(os.sep)
+    return (rel_dir, rel_dir.count(os.sep) + 1, parent, name)
+
+def save_directory_structure(directories, output_file):
     print("\nSaving directory structure to CSV...")
-    # Define CSV headers for directory structure
-    headers = ['directory_path', 'depth', 'parent_directory', 'directory_name']
     
-    # Write to CSV file with progress bar
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=headers)
-        writer.writeheader()
-        
-        # Write rows with progress bar
-        for row in tqdm(dir_data, desc="Writing directory structure", unit="dir"):
-            writer.writerow(row)
+    with BlockCsvWriter(output_file, DIR_HEADERS) as writer:
+        writer.writerows(directory_row(rel_dir) for rel_dir in sorted(directories))
 
 def normalize_path_to_filename(path, prefix):
     # Get the last directory name from the path
@@ -201,29 +410,49 @@ def main():
     # Initialize statistics
     stats = FileStats()
     
-    # Clean directory and get remaining files
-    file_data = clean_directory(ROOT_DIRECTORY, stats)
-    
-    # Get directory structure
-    dir_data = get_directory_structure(file_data)
-    
-    # Generate output filenames and save both inventories
+    # Generate output filenames for both inventories
     files_filename = normalize_path_to_filename(ROOT_DIRECTORY, "inventory_files")
     dirs_filename = normalize_path_to_filename(ROOT_DIRECTORY, "inventory_dirs")
     
     files_csv = os.path.join(OUTPUT_DIRECTORY, files_filename)
     dirs_csv = os.path.join(OUTPUT_DIRECTORY, dirs_filename)
     
-    save_to_csv(file_data, files_csv)
-    save_directory_structure(dir_data, dirs_csv)
+    # Skip formatting sizes for humans if the spreadsheet will do it
+    if HUMAN_READABLE_SIZES:
+        file_headers, make_row = FILE_HEADERS, file_row
+    else:
+        file_headers, make_row = RAW_SIZE_FILE_HEADERS, file_row_raw_size
+    
+    # Clean directory and stream the remaining files to CSV
+    directories = set()
+    scan = clean_directory(ROOT_DIRECTORY, stats, directories)
+    file_writer = BlockCsvWriter(files_csv, file_headers)
+    try:
+        for dir_files in scan:
+            file_writer.writerows(map(make_row, dir_files))
+    except BaseException:
+        # Stop the scan right away rather than whenever it is garbage collected
+        scan.close()
+        file_writer.close()
+        raise
+    
+    # Flush the tail of the files inventory while the directory structure is written
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(file_writer.close),
+            executor.submit(save_directory_structure, directories, dirs_csv)
+        ]
+        for future in futures:
+            future.result()
     
     # Print summary
     print(f"\nCleanup and Inventory Summary:")
     print(f"Total files processed: {stats.total_files}")
     print(f"Files cleaned up: {stats.cleaned_files}")
+    print(f"Metadata directories removed: {stats.cleaned_dirs}")
     print(f"Space freed: {humanize.naturalsize(stats.cleaned_size)}")
-    print(f"Remaining files inventoried: {len(file_data)}")
-    print(f"Directories inventoried: {len(dir_data)}")
+    print(f"Remaining files inventoried: {stats.inventoried_files}")
+    print(f"Directories inventoried: {len(directories)}")
     print(f"\nOutput files:")
     print(f"- Files inventory: {files_csv}")
     print(f"- Directory structure: {dirs_csv}")